@@ -1,11 +1,27 @@
 import argparse
+import ctypes
+import hashlib
+import heapq
 import time
 import os
+import platform
+import select
 import yaml
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import shutil
+import signal
+import stat
 import subprocess
-import schedule
-from pathlib import Path
+import threading
+from operator import itemgetter
+
+# Парсер YAML на libyaml, если PyYAML собран с ним
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 
 # Настройка парсера аргументов командной строки
@@ -16,14 +32,301 @@ args = parser.parse_args()
 dvr_config_file = args.config_file
 
 def read_dvr_config(config_file):
-    with open(dvr_config_file, 'r') as file:
-        return yaml.safe_load(file)
+    with open(config_file, 'rb') as file:
+        return yaml.load(file, Loader=YamlLoader)
 
 config = read_dvr_config(dvr_config_file)
+print(f"YAML loader: {YamlLoader.__name__}")
 base_dir = config['base_dir']
 stream_server = config['stream_server']
 target_size_gb = config['target_size_gb']
 go2rtc_config_path = config['go2rtc_config_path']
+single_ffmpeg = config.get('single_ffmpeg', False)
+use_system_rm = config.get('use_system_rm', False)
+ffmpeg_threads = config.get('ffmpeg_threads')
+ffmpeg_log_dir = config.get('ffmpeg_log_dir')
+
+# Длительность одного файла записи в секундах (с запасом на стык с файлом следующего интервала)
+RECORD_DURATION = 607
+
+
+# Результаты обхода каталогов, в которые уже не идёт запись:
+# {папка камеры: {каталог: (mtime_ns каталога, записи о файлах)}}
+_dir_scan_cache = {}
+# Каталог или файл считается устоявшимся, когда с его последнего изменения прошло две длительности записи:
+# до этого в нём может расти файл, который пишет ffmpeg
+SETTLED_AGE_NS = 2 * RECORD_DURATION * 10 ** 9
+
+# Файлы, запись которых начата: (папка камеры, путь к файлу); разбираются потоком очистки
+_recorded_files = deque()
+# Место, занятое устоявшимися файлами камеры, и время полного обхода: {папка камеры: (байты, monotonic)}
+_camera_bytes = {}
+# Файлы, которые ещё могут расти: {папка камеры: {путь: время постановки в учёт, нс}}
+_growing_files = {}
+# Даже если счётчик ниже целевого размера, папка камеры обходится полностью не реже этого интервала
+FULL_SCAN_INTERVAL = 3600
+
+
+def _scan_camera_files(camera_dir):
+    """
+    Обходит папку камеры за один проход и собирает сведения о файлах.
+    Файлы опрашиваются через fstatat относительно уже открытого каталога,
+    без повторного разбора полного пути. Для давно не менявшихся каталогов
+    используются сведения прошлого обхода, пока не изменится mtime каталога.
+
+    :param camera_dir: Путь к папке камеры.
+    :return: Список кортежей (mtime_ns, занятое место в байтах, путь относительно папки камеры)
+             и словарь {каталог без подкаталогов: число записей в нём}.
+    """
+    camera_dir = str(camera_dir)
+    prefix_len = len(camera_dir) + 1
+    entries = []
+    leaf_dir_counts = {}
+    cache = _dir_scan_cache.get(camera_dir, {})
+    new_cache = {}
+    settled_before = time.time_ns() - SETTLED_AGE_NS
+    for dirpath, dirnames, filenames, dir_fd in os.fwalk(camera_dir):
+        rel_dir = dirpath[prefix_len:]
+        if rel_dir and not dirnames:
+            leaf_dir_counts[rel_dir] = len(filenames)
+        dir_mtime = os.fstat(dir_fd).st_mtime_ns
+        cached = cache.get(rel_dir)
+        if cached is not None and cached[0] == dir_mtime:
+            entries.extend(cached[1])
+            new_cache[rel_dir] = cached
+            continue
+        dir_entries = []
+        for name in filenames:
+            try:
+                st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                # Место на диске считается по выделенным блокам, а не по длине файла
+                dir_entries.append((st.st_mtime_ns, st.st_blocks * 512, os.path.join(rel_dir, name)))
+        entries.extend(dir_entries)
+        if dir_mtime < settled_before:
+            new_cache[rel_dir] = (dir_mtime, dir_entries)
+    # Удалённые каталоги выпадают из кеша сами: в новый попадают только найденные при обходе
+    _dir_scan_cache[camera_dir] = new_cache
+    return entries, leaf_dir_counts
+
+
+def _estimated_camera_size(camera_dir):
+    """
+    Оценивает место, занятое папкой камеры, по счётчику, без обхода каталогов.
+    Устоявшиеся файлы переносятся в счётчик, растущие учитываются по текущему размеру.
+
+    :param camera_dir: Путь к папке камеры.
+    :return: Размер в байтах или None, если нужен полный обход.
+    """
+    known = _camera_bytes.get(camera_dir)
+    if known is None or time.monotonic() - known[1] > FULL_SCAN_INTERVAL:
+        return None
+    size, scanned_at = known
+    settled_before = time.time_ns() - SETTLED_AGE_NS
+    growing_size = 0
+    still_growing = {}
+    for path, added_at in _growing_files.get(camera_dir, {}).items():
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except FileNotFoundError:
+            # ffmpeg мог ещё не создать файл; давно пропавший файл больше не ждём
+            if added_at >= settled_before:
+                still_growing[path] = added_at
+            continue
+        if st.st_mtime_ns < settled_before:
+            size += st.st_blocks * 512
+        else:
+            growing_size += st.st_blocks * 512
+            still_growing[path] = added_at
+    _camera_bytes[camera_dir] = (size, scanned_at)
+    _growing_files[camera_dir] = still_growing
+    return size + growing_size
+
+
+def _select_oldest(entries, size, space_to_free):
+    """
+    Отбирает самые старые файлы, удаление которых освободит нужное место.
+    Сортируется не весь список, а только оценка нужного числа файлов.
+
+    :param entries: Список кортежей (mtime_ns, занятое место в байтах, путь).
+    :param size: Суммарное место, занятое файлами.
+    :param space_to_free: Сколько байт нужно освободить.
+    :return: Пути отобранных файлов, от самых старых к новым.
+    """
+    average = size / len(entries)
+    count = max(16, int(space_to_free / average * 1.25))
+    while True:
+        victims = []
+        freed = 0
+        for _, file_size, path in heapq.nsmallest(count, entries, key=itemgetter(0)):
+            if freed >= space_to_free:
+                return victims
+            victims.append(path)
+            freed += file_size
+        # Оценки не хватило: файлы в начале оказались мельче среднего
+        if freed >= space_to_free or count >= len(entries):
+            return victims
+        count *= 2
+
+
+def _open_dir(path):
+    """
+    Открывает каталог для операций относительно его дескриптора.
+
+    :param path: Путь к каталогу.
+    :return: Дескриптор каталога или None, если платформа не поддерживает dir_fd.
+    """
+    if os.unlink not in os.supports_dir_fd:
+        return None
+    return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+
+def _drop_and_unlink(path, dir_fd=None):
+    """
+    Удаляет файл, предварительно вытеснив его страницы из page cache.
+    Сам unlink страницы не освобождает, и они занимали бы память до вытеснения.
+
+    :param path: Путь к файлу (относительно dir_fd, если он задан).
+    :param dir_fd: Дескриптор каталога или None.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+        except OSError:
+            pass
+        else:
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+    os.unlink(path, dir_fd=dir_fd)
+
+
+def _batched_unlink(root, root_fd, paths):
+    """
+    Удаляет отобранные файлы одной пачкой, без перемежения с отбором.
+    Файлы группируются по каталогам: каждый каталог открывается один раз,
+    и файлы удаляются по имени относительно его дескриптора.
+
+    :param root: Каталог, относительно которого заданы пути.
+    :param root_fd: Дескриптор каталога root или None.
+    :param paths: Относительные пути к удаляемым файлам.
+    :return: Список удалённых путей.
+    """
+    groups = {}
+    for path in paths:
+        directory, name = os.path.split(path)
+        groups.setdefault(directory, []).append(name)
+
+    deleted = []
+    for directory, names in groups.items():
+        dir_fd = None
+        if root_fd is not None:
+            try:
+                dir_fd = os.open(directory or '.', os.O_RDONLY | os.O_DIRECTORY, dir_fd=root_fd)
+            except OSError as e:
+                print(f"Error opening directory {os.path.join(root, directory)}: {e}")
+                continue
+        try:
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    if dir_fd is None:
+                        _drop_and_unlink(os.path.join(root, path))
+                    else:
+                        _drop_and_unlink(name, dir_fd)
+                    print(f"Deleted {os.path.join(root, path)}")
+                    deleted.append(path)
+                except OSError as e:
+                    print(f"Error deleting file {os.path.join(root, path)}: {e}")
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+    return deleted
+
+
+def _prune_empty_dirs(root, root_fd, dirs):
+    """
+    Удаляет опустевшие каталоги, начиная с самых глубоких и поднимаясь к root.
+    Проверяются только каталоги, из которых удалялись файлы, а не всё дерево.
+
+    :param root: Каталог, относительно которого заданы пути.
+    :param root_fd: Дескриптор каталога root или None.
+    :param dirs: Относительные пути каталогов, из которых удалялись файлы.
+    :return: Количество удалённых каталогов.
+    """
+    removed = 0
+    pending = set(dirs)
+    pending.discard('')
+    while pending:
+        directory = max(pending, key=len)
+        pending.remove(directory)
+        try:
+            if root_fd is None:
+                os.rmdir(os.path.join(root, directory))
+            else:
+                os.rmdir(directory, dir_fd=root_fd)
+        except OSError:
+            # Каталог не пуст или уже удалён
+            continue
+        removed += 1
+        parent = os.path.dirname(directory)
+        if parent:
+            pending.add(parent)
+    return removed
+
+
+def _split_whole_dirs(victims, leaf_dir_counts):
+    """
+    Выделяет каталоги, все файлы которых отобраны на удаление.
+
+    :param victims: Относительные пути отобранных файлов.
+    :param leaf_dir_counts: Число записей в каждом каталоге без подкаталогов.
+    :return: Список таких каталогов и список остальных отобранных файлов.
+    """
+    per_dir = {}
+    for path in victims:
+        directory = os.path.dirname(path)
+        per_dir[directory] = per_dir.get(directory, 0) + 1
+    whole_dirs = [d for d, count in per_dir.items() if leaf_dir_counts.get(d) == count]
+    whole = set(whole_dirs)
+    rest = [path for path in victims if os.path.dirname(path) not in whole]
+    return whole_dirs, rest
+
+
+def _remove_whole_dirs(root, dirs):
+    """
+    Удаляет каталоги целиком командой rm -rf.
+    Страницы удаляемых файлов при этом не вытесняются из page cache.
+
+    :param root: Каталог, относительно которого заданы пути.
+    :param dirs: Относительные пути удаляемых каталогов.
+    :return: Список удалённых каталогов.
+    """
+    removed = []
+    for directory in dirs:
+        path = os.path.join(root, directory)
+        result = subprocess.run(['rm', '-rf', '--', path], stdin=subprocess.DEVNULL, check=False)
+        if result.returncode != 0 or os.path.lexists(path):
+            print(f"Error deleting directory {path}")
+            continue
+        print(f"Deleted {path}")
+        removed.append(directory)
+    return removed
+
+
+def _is_empty_dir(path):
+    """
+    Проверяет, пуст ли каталог, читая не более одной записи.
+
+    :param path: Путь к каталогу.
+    """
+    with os.scandir(path) as it:
+        return next(it, None) is None
 
 
 # Функция очистки папок
@@ -34,84 +337,445 @@ def clean_camera_folders(base_dir, target_size_gb):
     :param base_dir: Путь к каталогу, содержащему папки камер.
     :param target_size_gb: Целевой размер папки в гигабайтах.
     """
-    base_dir = Path(base_dir)
+    base_dir = str(base_dir)
+    target_size = target_size_gb * (1024 ** 3)
     # Удалить пустые папки
-    for folder in base_dir.iterdir():
-        if folder.is_dir() and not any(folder.iterdir()):
-            folder.rmdir()
-    # Перебор папок камер
-    for camera_dir in base_dir.iterdir():
-        if camera_dir.is_dir():
-            # Получить текущий размер папки камеры в ГБ
-            size_gb = sum(f.stat().st_size for f in camera_dir.glob('**/*') if f.is_file()) / (1024 ** 3)
-
-            # Рассчитать, сколько нужно удалить, чтобы достичь целевого размера
-            space_to_free_gb = size_gb - target_size_gb
-
-            # Проверить, превышает ли текущий размер целевой размер
-            if space_to_free_gb > 0:
-                print(f"Cleaning {camera_dir}")
-                # Получить список файлов, отсортированных по времени изменения (от самых старых до самых новых)
-                files = list(camera_dir.glob('**/*'))
-                files.sort(key=os.path.getmtime)
-
-                # Удалить файлы, пока размер папки не уменьшится до целевого размера
-                for file in files:
-                    if space_to_free_gb <= 0:
-                        break
-                    if file.is_file():
-                        file_size_gb = file.stat().st_size / (1024 ** 3)
-                        try:
-                            file.unlink()
-                            print(f"Deleted {file}")
-                            space_to_free_gb -= file_size_gb
-                        except Exception as e:
-                            print(f"Error deleting file {file}: {e}")
+    base_fd = _open_dir(base_dir)
+    try:
+        with os.scandir(base_dir) as it:
+            for folder in it:
+                if not folder.is_dir(follow_symlinks=False):
+                    continue
+                # Запись могла как раз создать в папке каталог дня, а папка может быть точкой монтирования:
+                # ошибка одной папки не должна останавливать очистку остальных камер
+                try:
+                    if not _is_empty_dir(folder.path):
+                        continue
+                    if base_fd is None:
+                        os.rmdir(folder.path)
+                    else:
+                        os.rmdir(folder.name, dir_fd=base_fd)
+                except OSError as e:
+                    print(f"Error deleting empty folder {folder.path}: {e}")
+                    continue
+                _day_dirs.pop(folder.name, None)
+                _dir_scan_cache.pop(folder.path, None)
+                _camera_bytes.pop(folder.path, None)
+                _growing_files.pop(folder.path, None)
+    finally:
+        if base_fd is not None:
+            os.close(base_fd)
+    # Начатые записи ставятся в учёт до запуска потоков очистки камер
+    now_ns = time.time_ns()
+    while _recorded_files:
+        camera_dir, path = _recorded_files.popleft()
+        _growing_files.setdefault(camera_dir, {})[path] = now_ns
+    # Перебор папок камер: каждая папка очищается независимо, в своём потоке
+    with os.scandir(base_dir) as it:
+        camera_dirs = [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+    if not camera_dirs:
+        return
+    with ThreadPoolExecutor(max_workers=min(8, len(camera_dirs))) as pool:
+        futures = {pool.submit(_clean_one_camera, camera_dir, target_size): camera_dir
+                   for camera_dir in camera_dirs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error cleaning {futures[future]}: {e}")
+
+
+def _clean_one_camera(camera_dir, target_size):
+    """
+    Удаляет самые старые файлы одной камеры, пока её папка не уменьшится до целевого размера.
+
+    :param camera_dir: Путь к папке камеры.
+    :param target_size: Целевой размер папки в байтах.
+    """
+    # Пока счётчик ниже целевого размера, папка не обходится
+    estimated = _estimated_camera_size(camera_dir)
+    if estimated is not None and estimated <= target_size:
+        return
+    # Один обход папки: размеры и время изменения берутся из одного stat
+    scanned_at = time.monotonic()
+    entries, leaf_dir_counts = _scan_camera_files(camera_dir)
+    size = sum(entry[1] for entry in entries)
+    # Недавно изменённые файлы ещё могут расти: они учитываются отдельно от счётчика
+    settled_before = time.time_ns() - SETTLED_AGE_NS
+    growing = {path: added_at for path, added_at in _growing_files.get(camera_dir, {}).items()
+               if added_at >= settled_before}
+    settled_size = 0
+    for mtime, file_size, path in entries:
+        if mtime < settled_before:
+            settled_size += file_size
+        else:
+            growing[os.path.join(camera_dir, path)] = mtime
+    _growing_files[camera_dir] = growing
+
+    # Рассчитать, сколько нужно удалить, чтобы достичь целевого размера
+    space_to_free = size - target_size
+
+    # Проверить, превышает ли текущий размер целевой размер
+    if space_to_free <= 0:
+        _camera_bytes[camera_dir] = (settled_size, scanned_at)
+        return
+    # Если удаление прервётся ошибкой, размер папки определит следующий полный обход
+    _camera_bytes.pop(camera_dir, None)
+    print(f"Cleaning {camera_dir}")
+    # Отобрать самые старые файлы, пока размер папки не уменьшится до целевого размера
+    victims = _select_oldest(entries, size, space_to_free)
+    whole_dirs = []
+    if use_system_rm:
+        # Каталоги, удаляемые целиком, отдаются rm -rf вместо удаления по одному файлу
+        whole_dirs, victims = _split_whole_dirs(victims, leaf_dir_counts)
+    camera_fd = _open_dir(camera_dir)
+    try:
+        removed_dirs = _remove_whole_dirs(camera_dir, whole_dirs)
+        deleted = _batched_unlink(camera_dir, camera_fd, victims)
+        # Удалить каталоги дней, месяцев и лет, которые опустели после очистки
+        touched = {os.path.dirname(path) for path in deleted + removed_dirs}
+        if _prune_empty_dirs(camera_dir, camera_fd, touched) or removed_dirs:
+            # Каталог текущего дня мог быть удалён: при следующей записи его нужно создать заново
+            _day_dirs.pop(os.path.basename(camera_dir), None)
+    finally:
+        if camera_fd is not None:
+            os.close(camera_fd)
+    # Счётчик уменьшается на размер удалённых файлов; размеры известны из обхода
+    deleted_files = set(deleted)
+    removed_dirs = set(removed_dirs)
+    for mtime, file_size, path in entries:
+        if path in deleted_files or os.path.dirname(path) in removed_dirs:
+            if mtime < settled_before:
+                settled_size -= file_size
+            else:
+                growing.pop(os.path.join(camera_dir, path), None)
+    _camera_bytes[camera_dir] = (settled_size, scanned_at)
+
+
+# Запросы на очистку; повторные запросы, пришедшие во время очистки, сливаются в один
+cleanup_event = threading.Event()
+
+
+# Номер системного вызова ioprio_set на архитектурах, для которых собирается образ
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289, 'i486': 289, 'i586': 289, 'i686': 289,
+    'armv6l': 314, 'armv7l': 314, 'armv8l': 314,
+    'aarch64': 30,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def _lower_cleanup_priority():
+    """
+    Понижает приоритет текущего потока: планировщик CPU считает его фоновым (SCHED_BATCH),
+    а дисковый ввод-вывод получает класс idle, чтобы очистка не мешала записи потоков.
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_BATCH, os.sched_param(0))
+    except (AttributeError, OSError) as e:
+        print(f"Could not set SCHED_BATCH for cleanup: {e}")
+    syscall_nr = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall_nr is None:
+        return
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(syscall_nr, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+            print(f"Could not set idle I/O priority for cleanup: {os.strerror(ctypes.get_errno())}")
+    except (AttributeError, OSError) as e:
+        print(f"Could not set idle I/O priority for cleanup: {e}")
+
+
+def cleanup_worker():
+    """
+    Фоновый поток очистки: запуск записи не ждёт обхода и удаления старых файлов.
+    """
+    _lower_cleanup_priority()
+    while True:
+        cleanup_event.wait()
+        cleanup_event.clear()
+        try:
+            clean_camera_folders(base_dir, target_size_gb)
+        except Exception as e:
+            print(f"Error cleaning camera folders: {e}")
+
+
+# Разобранный конфиг go2rtc, имена его потоков, время изменения, размер и хеш содержимого файла
+_CACHED_GO2RTC = {'stat': None, 'digest': None, 'data': None, 'streams': ()}
+
+
+def load_go2rtc_config():
+    """
+    Возвращает конфиг go2rtc, перечитывая файл только если изменились его время изменения или размер.
+    Если содержимое при этом осталось тем же, YAML не разбирается заново.
+    """
+    st = os.stat(go2rtc_config_path)
+    file_stat = (st.st_mtime_ns, st.st_size)
+    if file_stat != _CACHED_GO2RTC['stat'] or _CACHED_GO2RTC['data'] is None:
+        with open(go2rtc_config_path, 'rb') as file:
+            content = file.read()
+        digest = hashlib.blake2b(content, digest_size=8).digest()
+        if digest != _CACHED_GO2RTC['digest'] or _CACHED_GO2RTC['data'] is None:
+            _CACHED_GO2RTC['data'] = yaml.load(content, Loader=YamlLoader)
+            _CACHED_GO2RTC['streams'] = tuple((_CACHED_GO2RTC['data'] or {}).get('streams') or ())
+            _CACHED_GO2RTC['digest'] = digest
+        _CACHED_GO2RTC['stat'] = file_stat
+    return _CACHED_GO2RTC['data']
+
+
+def load_stream_names():
+    """
+    Возвращает имена потоков из конфига go2rtc; кортеж строится только при разборе файла.
+    """
+    load_go2rtc_config()
+    return _CACHED_GO2RTC['streams']
+
+
+# Запущенные процессы ffmpeg по имени потока и обратный индекс pid -> имя потока
+active_processes = {}
+_pid_to_name = {}
+# Последний созданный каталог дня для каждого потока
+_day_dirs = {}
+
+
+def _forget_process(pid, returncode):
+    """
+    Убирает завершившийся процесс ffmpeg из учёта.
+
+    :param pid: Идентификатор процесса.
+    :param returncode: Код завершения или None, если он неизвестен.
+    """
+    stream_name = _pid_to_name.pop(pid, None)
+    process = active_processes.get(stream_name)
+    # Запись потока могла уже перейти к процессу следующего интервала
+    if process is not None and process.pid == pid:
+        if returncode is not None:
+            process.returncode = returncode
+        del active_processes[stream_name]
+
+
+def _on_sigchld(signum, frame):
+    """
+    Забирает статусы завершившихся процессов ffmpeg, когда ядро присылает SIGCHLD.
+    Ожидаются только процессы из _pid_to_name: остальных дочерних (например, rm)
+    ожидают те, кто их запустил.
+    """
+    for pid in list(_pid_to_name):
+        try:
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            # Статус уже забрал subprocess при сборке мусора объекта Popen
+            _forget_process(pid, None)
+            continue
+        if reaped:
+            _forget_process(pid, os.waitstatus_to_exitcode(status))
+
+
+# Путь к ffmpeg определяется один раз, чтобы не перебирать PATH при каждом запуске
+FFMPEG_BIN = shutil.which('ffmpeg') or 'ffmpeg'
+
+# Неизменные части команды ffmpeg: общие параметры, параметры входа и параметры выхода
+FFMPEG_GLOBAL_ARGS = ('ffmpeg', '-hide_banner', '-loglevel', 'warning')
+FFMPEG_INPUT_ARGS = (
+    '-avoid_negative_ts', 'make_zero', '-fflags', '+nobuffer+genpts+discardcorrupt',
+    '-flags', 'low_delay', '-rtsp_transport', 'tcp', '-use_wallclock_as_timestamps', '1',
+)
+FFMPEG_OUTPUT_ARGS = (
+    '-reset_timestamps', '1', '-strftime', '1',
+    '-c:v', 'copy', '-c:a', 'aac', '-strict', 'experimental',
+)
+# Имя, под которым учитывается общий процесс ffmpeg в режиме single_ffmpeg
+SINGLE_FFMPEG_NAME = '*'
+# Открытые журналы ffmpeg по имени потока; журнал больше этого размера переименовывается в .log.1
+_ffmpeg_logs = {}
+FFMPEG_LOG_MAX_BYTES = 10 * 1024 ** 2
+
+
+def _open_ffmpeg_log(name):
+    """
+    Возвращает дескриптор журнала ffmpeg для потока, если задан ffmpeg_log_dir.
+    Журнал обрезается при первом запуске потока после старта записи, а затем все процессы потока
+    дописывают в него свой stderr. Когда журнал превышает FFMPEG_LOG_MAX_BYTES, он переименовывается
+    в <имя>.log.1 (прежний .log.1 заменяется), и новый процесс пишет в новый файл.
+
+    :param name: Имя потока, под которым учитывается процесс.
+    :return: Дескриптор файла журнала или None, если вывод нужно отбросить.
+    """
+    if not ffmpeg_log_dir:
+        return None
+    file_name = 'ffmpeg.log' if name == SINGLE_FFMPEG_NAME else f"{name}.log"
+    path = os.path.join(ffmpeg_log_dir, file_name)
+    log_fd = _ffmpeg_logs.get(name)
+    try:
+        if log_fd is not None:
+            if os.fstat(log_fd).st_size <= FFMPEG_LOG_MAX_BYTES:
+                return log_fd
+            # Процесс прошлого интервала продолжит писать в переименованный файл
+            del _ffmpeg_logs[name]
+            os.close(log_fd)
+            os.replace(path, path + '.1')
+        else:
+            os.makedirs(ffmpeg_log_dir, exist_ok=True)
+        # O_APPEND: несколько процессов потока пишут в один файл, не затирая вывод друг друга
+        log_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+    except OSError as e:
+        print(f"Error opening ffmpeg log for {name}: {e}")
+        return None
+    _ffmpeg_logs[name] = log_fd
+    return log_fd
+
+
+def start_ffmpeg(name, command):
+    """
+    Запускает ffmpeg без ожидания завершения и регистрирует процесс.
+
+    :param name: Имя потока, под которым учитывается процесс.
+    :param command: Аргументы командной строки ffmpeg.
+    :return: Запущенный процесс.
+    """
+    # Вывод ffmpeg не читается через канал: непрочитанный канал со временем заблокировал бы запись
+    log_fd = _open_ffmpeg_log(name)
+    process = subprocess.Popen(command, executable=FFMPEG_BIN, close_fds=False, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL if log_fd is None else log_fd)
+    active_processes[name] = process
+    _pid_to_name[process.pid] = name
+    # ffmpeg мог завершиться раньше, чем попал в _pid_to_name, и его SIGCHLD уже был обработан
+    returncode = process.poll()
+    if returncode is not None:
+        _forget_process(process.pid, returncode)
+    return process
 
 
 # Функция для записи потоков
 def record_streams(duration, base_dir, stream_server):
-    with open(go2rtc_config_path, 'r') as file:
-        config_data = yaml.safe_load(file)
-    streams = config_data['streams'].keys()
+    streams = load_stream_names()
+    if not streams:
+        cleanup_event.set()
+        return
 
-    now = datetime.now()
-    year, month, day = now.strftime("%Y"), now.strftime("%m"), now.strftime("%d")
-    current_time = now.strftime("%H-%M")
-    M = now.strftime("%M")
+    # Части пути берутся из одного localtime без повторных вызовов strftime
+    now = time.localtime()
+    year, month, day = f"{now.tm_year:04d}", f"{now.tm_mon:02d}", f"{now.tm_mday:02d}"
+    current_time = f"{now.tm_hour:02d}-{now.tm_min:02d}"
 
-    processes = []
+    outputs = []
+    duration_str = str(duration)
+    # Все потоки пишутся одновременно: делим ядра между ними, чтобы не плодить лишние потоки ffmpeg
+    threads = ffmpeg_threads or max(1, (os.cpu_count() or 4) // max(1, len(streams)))
+    input_args = ('-threads', str(threads), *FFMPEG_INPUT_ARGS)
 
     for stream_name in streams:
         directory = os.path.join(base_dir, stream_name, year, month, day)
-        os.makedirs(directory, exist_ok=True)
+        # Каталог дня меняется только в полночь, остальные циклы обходятся без mkdir
+        if _day_dirs.get(stream_name) != directory:
+            os.makedirs(directory, exist_ok=True)
+            _day_dirs[stream_name] = directory
         output_file = os.path.join(directory, f"{current_time}.mp4")
-        command = [
-            'ffmpeg', '-hide_banner', '-loglevel', 'warning', '-threads', '2',
-            '-avoid_negative_ts', 'make_zero', '-fflags', '+nobuffer+genpts+discardcorrupt',
-            '-flags', 'low_delay', '-rtsp_transport', 'tcp', '-use_wallclock_as_timestamps', '1',
-            '-i', f"{stream_server}/{stream_name}", '-reset_timestamps', '1', '-strftime', '1',
-            '-c:v', 'copy', '-c:a', 'aac', '-strict', 'experimental', '-t', str(duration), output_file
-        ]
-        #log_file = os.path.join(base_dir, f"{stream_name}_{M}.txt")
-        # Запуск субпроцесса без ожидания его завершения
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        processes.append(process)
-
-    # Очистка папок до размера target_size_gb Гб
-    clean_camera_folders(base_dir, target_size_gb)
-    # Возвращаем список запущенных процессов, если нужно контролировать их в будущем
-    return processes
-
-
-duration = 607
-# Планируем задачу на каждые 10 минут
-schedule.every().hour.at(":00").do(record_streams, duration, base_dir, stream_server)
-schedule.every().hour.at(":10").do(record_streams, duration, base_dir, stream_server)
-schedule.every().hour.at(":20").do(record_streams, duration, base_dir, stream_server)
-schedule.every().hour.at(":30").do(record_streams, duration, base_dir, stream_server)
-schedule.every().hour.at(":40").do(record_streams, duration, base_dir, stream_server)
-schedule.every().hour.at(":50").do(record_streams, duration, base_dir, stream_server)
+        outputs.append((stream_name, output_file))
+        _recorded_files.append((os.path.join(base_dir, stream_name), output_file))
+
+    if single_ffmpeg:
+        # Один процесс ffmpeg на все потоки: каждый вход отображается в свой файл
+        if outputs:
+            command = list(FFMPEG_GLOBAL_ARGS)
+            for stream_name, _ in outputs:
+                command += (*input_args, '-i', f"{stream_server}/{stream_name}")
+            for index, (_, output_file) in enumerate(outputs):
+                command += ('-map', str(index), *FFMPEG_OUTPUT_ARGS, '-t', duration_str, output_file)
+            start_ffmpeg(SINGLE_FFMPEG_NAME, command)
+    else:
+        for stream_name, output_file in outputs:
+            command = (
+                *FFMPEG_GLOBAL_ARGS, *input_args, '-i', f"{stream_server}/{stream_name}",
+                *FFMPEG_OUTPUT_ARGS, '-t', duration_str, output_file
+            )
+            start_ffmpeg(stream_name, command)
+
+    # Очистка папок до размера target_size_gb Гб выполняется в фоновом потоке
+    cleanup_event.set()
+
+
+def next_slot_time(ts, interval):
+    """
+    Возвращает момент начала следующего интервала записи по местному времени.
+
+    :param ts: Текущее время (секунды с начала эпохи).
+    :param interval: Длина интервала в секундах.
+    :return: Время начала следующего интервала, строго большее ts.
+    """
+    local = time.localtime(ts)
+    elapsed = (local.tm_min * 60 + local.tm_sec) % interval + ts % 1
+    return ts + interval - elapsed
+
+
+def wait_for_signal(timeout):
+    """
+    Ждёт до timeout секунд или до прихода любого сигнала.
+    Обработчики сигналов Python выполняются сразу после пробуждения.
+
+    :param timeout: Максимальное время ожидания в секундах.
+    """
+    select.select([wakeup_r], [], [], timeout)
+    try:
+        while os.read(wakeup_r, 512):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def _on_termination(signum, frame):
+    """
+    Запоминает сигнал завершения; сама остановка выполняется в основном цикле.
+    """
+    global shutdown_signal
+    shutdown_signal = signum
+
+
+def stop_recordings(timeout=5):
+    """
+    Останавливает все процессы ffmpeg: сначала SIGTERM, чтобы ffmpeg дописал файлы,
+    затем SIGKILL для тех, кто не завершился за timeout секунд.
+
+    :param timeout: Время ожидания завершения в секундах.
+    """
+    for pid in list(_pid_to_name):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    # Обработчик SIGCHLD убирает завершившиеся процессы из _pid_to_name
+    deadline = time.monotonic() + timeout
+    while _pid_to_name:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        wait_for_signal(remaining)
+    for pid in list(_pid_to_name):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+duration = RECORD_DURATION
+# Запись запускается в начале каждого 10-минутного интервала
+interval = 600
+
+# Сигналы будят основной цикл через этот канал
+wakeup_r, wakeup_w = os.pipe()
+os.set_blocking(wakeup_r, False)
+os.set_blocking(wakeup_w, False)
+signal.set_wakeup_fd(wakeup_w)
+
+# Завершившиеся процессы забираются по сигналу, без периодического опроса
+signal.signal(signal.SIGCHLD, _on_sigchld)
+shutdown_signal = None
+signal.signal(signal.SIGTERM, _on_termination)
+signal.signal(signal.SIGINT, _on_termination)
+
+threading.Thread(target=cleanup_worker, daemon=True).start()
 
 ## Запуск записи при старте.
 now = datetime.now()
@@ -119,7 +783,20 @@ next_interval = (now.minute // 10 + 1) * 10
 remaining_time = (next_interval - now.minute) * 60 - now.second
 record_streams(remaining_time, base_dir, stream_server)
 
-# Основной цикл
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+# Основной цикл: спим до начала следующего интервала вместо ежесекундного опроса
+next_slot = next_slot_time(time.time(), interval)
+while shutdown_signal is None:
+    now = time.time()
+    delay = next_slot - now
+    if delay > interval:
+        # Часы переведены назад (например, NTP): граница интервала считается заново, иначе запись пропустит интервалы
+        next_slot = next_slot_time(now, interval)
+        continue
+    if delay > 0:
+        wait_for_signal(delay)
+        continue
+    record_streams(duration, base_dir, stream_server)
+    next_slot = next_slot_time(max(next_slot, time.time()), interval)
+
+print(f"Received signal {shutdown_signal}, stopping recordings")
+stop_recordings()